@@ -3,17 +3,193 @@
 
 get_disk_usage() {
     node_name=$1
-    disk_info=$(kubectl get --raw /api/v1/nodes/$node_name/proxy/stats/summary)
-    if [ $? -eq 0 ]; then
-        used_bytes=$(echo $disk_info | jq '.node.fs.usedBytes')
-        capacity_bytes=$(echo $disk_info | jq '.node.fs.capacityBytes')
-        disk_usage=$(echo | awk -v used="$used_bytes" -v capacity="$capacity_bytes" '{printf "%.2f%%", (used / capacity) * 100}')
-        echo "$disk_usage"
+    # stream the payload straight into jq rather than buffering it in a shell variable;
+    # node.fs precedes the per-pod stats, so jq stops reading as soon as both fields are seen
+    disk_usage=$(kubectl get --raw "/api/v1/nodes/$node_name/proxy/stats/summary" \
+        | jq -n -r --stream "$NODE_FS_JQ" \
+        | awk '{printf "%.2f%%\n", ($1 / $2) * 100}')
+    [ -n "$disk_usage" ] && echo "$disk_usage"
+}
+
+# print "<node> <disk usage>" for every node from a single Prometheus query
+get_prometheus_disk_usage() {
+    namespace=${prometheus_service%%/*}
+    service=${prometheus_service#*/}
+    query=$(jq -rn --arg q "$PROMETHEUS_DISK_QUERY" '$q | @uri')
+    # kube-prometheus relabels node_exporter's "instance" to the node name; other setups
+    # add a "node" label. Values that aren't node names (e.g. IP:port) are dropped later
+    disk_usage=$(kubectl get --raw "/api/v1/namespaces/$namespace/services/$service/proxy/api/v1/query?query=$query" \
+        | jq -r '.data.result[] | "\(.metric.node // .metric.instance) \(.value[1])"' \
+        | awk '{printf "%s %.2f%%\n", $1, $2}')
+    if [ -z "$disk_usage" ]; then
+        echo "Prometheus query returned no series." >&2
+        return 1
+    fi
+    echo "$disk_usage"
+}
+
+# print the node list reduced to what the script uses, so cached copies stay small
+get_nodes() {
+    kubectl get --raw /api/v1/nodes | jq -c "$NODES_PROJECTION_JQ"
+}
+
+# print "<node> <cpu> <cpu%> <memory> <memory%>" the way `kubectl top nodes` does,
+# from the metrics API joined with each node's allocatable resources
+get_node_metrics() {
+    cached "$metrics_cache_ttl" metrics kubectl get --raw /apis/metrics.k8s.io/v1beta1/nodes > "$tmp_dir/.metrics" &
+    metrics_pid=$!
+    cached "$nodes_cache_ttl" nodes get_nodes > "$tmp_dir/.nodes" &
+    nodes_pid=$!
+    wait "$metrics_pid" || return 1
+    wait "$nodes_pid" && [ -s "$tmp_dir/.nodes" ] || return 1
+    # a node that joined after the node list was cached has metrics but no allocatable
+    # yet; treat that as a cache miss (a TTL of 0 always refetches)
+    if [ -n "$cache_dir" ] \
+        && ! jq -e --slurpfile nodes "$tmp_dir/.nodes" "$NODES_COVER_METRICS_JQ" "$tmp_dir/.metrics" > /dev/null; then
+        cached 0 nodes get_nodes > "$tmp_dir/.nodes" && [ -s "$tmp_dir/.nodes" ] || return 1
+    fi
+    jq -r --slurpfile nodes "$tmp_dir/.nodes" "$NODE_METRICS_JQ" "$tmp_dir/.metrics"
+}
+
+# run a command, or replay its last output if that is younger than $1 seconds;
+# only successful, non-empty output is cached
+cached() {
+    ttl=$1
+    cache_file="$cache_dir/$2"
+    shift 2
+    if [ -z "$cache_dir" ]; then
+        "$@"
+        return
+    fi
+    if [ -f "$cache_file" ] && [ -f "$cache_file.ts" ] && read -r cached_at < "$cache_file.ts" \
+        && [ $((now - cached_at)) -lt "$ttl" ]; then
+        cat "$cache_file"
+        return
+    fi
+    # tagged with this run's pid so the EXIT trap can remove it if the run is interrupted
+    tmp_file=$(mktemp "$cache_file.tmp.$$.XXXXXX") || return 1
+    if "$@" > "$tmp_file" && [ -s "$tmp_file" ]; then
+        # data is replaced before its timestamp, so the timestamp is never newer than the data
+        mv "$tmp_file" "$cache_file"
+        echo "$now" > "$cache_file.ts"
+        cat "$cache_file"
     else
-        echo "Error"
+        rm -f "$tmp_file"
+        return 1
     fi
 }
 
+usage() {
+    echo "Usage: kubectl topd [--metrics-source=summary|prometheus|node-status] [--prometheus-service=NAMESPACE/NAME:PORT] [--concurrency=N] [--no-cache]"
+}
+
+# root filesystem usage as capacity - free (statfs Bfree), which is how the kubelet computes
+# usedBytes; avail_bytes (Bavail) would count root-reserved blocks as used
+PROMETHEUS_DISK_QUERY='100 * (1 - node_filesystem_free_bytes{mountpoint="/"} / node_filesystem_size_bytes{mountpoint="/"})'
+
+# node.fs usedBytes and capacityBytes, picked out of a `jq --stream` event stream
+NODE_FS_JQ='
+[limit(2; inputs | select(length == 2 and .[0][:2] == ["node", "fs"]
+                          and (.[0][2] == "usedBytes" or .[0][2] == "capacityBytes")))]
+| select(length == 2)
+| map({(.[0][2]): .[1]}) | add
+| "\(.usedBytes) \(.capacityBytes)"
+'
+
+# name, allocatable and condition statuses of each node; drops images, managedFields etc.
+NODES_PROJECTION_JQ='{items: [.items[] | {metadata: {name: .metadata.name},
+                                          status: {allocatable: .status.allocatable,
+                                                   conditions: [.status.conditions[]? | {type, status}]}}]}'
+
+# true when every node in the metrics list is also in the node list
+NODES_COVER_METRICS_JQ='(reduce $nodes[0].items[] as $node ({}; .[$node.metadata.name] = true)) as $known
+| all(.items[]; $known[.metadata.name])'
+
+# "<node> <DiskPressure condition status>" from the node list
+DISK_PRESSURE_JQ='.items[] | "\(.metadata.name) \(first(.status.conditions[]? | select(.type == "DiskPressure") | .status) // "Unknown")"'
+
+# quantities are converted to milli-units and rounded up, like resource.Quantity.MilliValue();
+# the suffix is looked up from the last one or two characters rather than matched with a regex
+NODE_METRICS_JQ='
+{"n": [1, 1000000], "u": [1, 1000], "m": [1, 1], "": [1000, 1],
+ "k": [1e6, 1], "M": [1e9, 1], "G": [1e12, 1], "T": [1e15, 1], "P": [1e18, 1], "E": [1e21, 1],
+ "Ki": [1024e3, 1], "Mi": [1048576e3, 1], "Gi": [1073741824e3, 1],
+ "Ti": [1099511627776e3, 1], "Pi": [1125899906842624e3, 1], "Ei": [1152921504606846976e3, 1]} as $scales
+| def to_milli:
+  (if $scales[.[-2:]] then .[-2:] elif $scales[.[-1:]] then .[-1:] else "" end) as $suffix
+  | $scales[$suffix] as [$mul, $div]
+  | .[:length - ($suffix | length)] | tonumber * $mul / $div
+  | ceil;
+def percent($used; $total):
+  (if $total then $total | to_milli else 0 end) as $t
+  | if $t > 0 then "\($used * 100 / $t | floor)%" else "<unknown>" end;
+(reduce $nodes[0].items[] as $node ({}; .[$node.metadata.name] = $node.status.allocatable)) as $allocatable
+| .items[]
+| .metadata.name as $name
+| (.usage.cpu | to_milli) as $cpu
+| (.usage.memory | to_milli) as $memory
+| "\($name) \($cpu)m \(percent($cpu; $allocatable[$name].cpu)) \($memory / 1000 | ceil / 1048576 | floor)Mi \(percent($memory; $allocatable[$name].memory))"
+'
+
+metrics_source=summary
+prometheus_service=kube-system/prometheus:9090
+concurrency=16
+use_cache=true
+
+# seconds a cached response stays valid, per endpoint; metrics-server refreshes
+# about every 15s, while node allocatable changes on the order of hours
+metrics_cache_ttl=15
+nodes_cache_ttl=600
+disk_cache_ttl=5
+
+for arg in "$@"; do
+    case $arg in
+        --metrics-source=*) metrics_source=${arg#*=} ;;
+        --prometheus-service=*) prometheus_service=${arg#*=} ;;
+        --concurrency=*) concurrency=${arg#*=} ;;
+        --no-cache) use_cache=false ;;
+        -h|--help) usage; exit 0 ;;
+        *) usage >&2; exit 1 ;;
+    esac
+done
+
+case $metrics_source in
+    summary|prometheus|node-status) ;;
+    *) echo "Invalid --metrics-source: $metrics_source" >&2; usage >&2; exit 1 ;;
+esac
+
+case $concurrency in
+    ''|*[!0-9]*|0) echo "Invalid --concurrency: $concurrency" >&2; usage >&2; exit 1 ;;
+esac
+
+# `wait -n` needs bash 4.3+ (macOS ships 3.2)
+if [ "${BASH_VERSINFO[0]}" -gt 4 ] || { [ "${BASH_VERSINFO[0]}" -eq 4 ] && [ "${BASH_VERSINFO[1]}" -ge 3 ]; }; then
+    has_wait_n=true
+else
+    has_wait_n=false
+fi
+
+# the node list now carries the disk column, so it can only be cached as long as disk usage
+if [ "$metrics_source" = node-status ]; then
+    nodes_cache_ttl=$disk_cache_ttl
+fi
+
+# responses are cached per kubeconfig and context; context names such as
+# "default" are commonly reused across kubeconfigs for different clusters
+cache_dir=""
+if [ "$use_cache" = true ]; then
+    now=${EPOCHSECONDS:-$(date +%s)}
+    context=$(kubectl config current-context 2>/dev/null)
+    read -r kubeconfig_sum _ <<< "$(printf '%s' "${KUBECONFIG:-$HOME/.kube/config}" | cksum)"
+    cache_root="${XDG_CACHE_HOME:-$HOME/.cache}/k8s-topd"
+    cache_dir="$cache_root/${context//\//_}-$kubeconfig_sum"
+    mkdir -p "$cache_dir" || cache_dir=""
+    # per-node entries of nodes that are gone would otherwise pile up on autoscaled
+    # clusters; anything a minute old is long past disk_cache_ttl, as are leftover
+    # temp files from runs that were killed outright
+    find "$cache_root" -type f \( -name 'summary-*' -o -name '*.tmp.*' \) -mmin +1 -exec rm -f {} + 2>/dev/null
+fi
+
 # column widths
 name_width=30
 cpu_cores_width=12
@@ -22,22 +198,89 @@ memory_bytes_width=14
 memory_percentage_width=10
 disk_usage_width=12
 
-printf "%-${name_width}s %-${cpu_cores_width}s %-${cpu_percentage_width}s %-${memory_bytes_width}s %-${memory_percentage_width}s %-${disk_usage_width}s\n" "NAME" "CPU(cores)" "CPU%" "MEMORY(bytes)" "MEMORY%" "DISK USAGE%"
+# expanded once, shared by the header and every row
+row_format="%-${name_width}s %-${cpu_cores_width}s %-${cpu_percentage_width}s %-${memory_bytes_width}s %-${memory_percentage_width}s %-${disk_usage_width}s\n"
+
+# disk usage results, one file per node named after the node
+tmp_dir=$(mktemp -d)
+cleanup() {
+    rm -rf "$tmp_dir"
+    # cache entries this run was still writing
+    if [ -n "$cache_dir" ]; then
+        rm -f "$cache_dir"/*.tmp.$$.*
+    fi
+}
+trap cleanup EXIT
 
-top_nodes=$(kubectl top nodes --no-headers)
+# the Prometheus query doesn't need node names, so run it alongside the node metrics
+if [ "$metrics_source" = prometheus ]; then
+    cached "$disk_cache_ttl" "prometheus-${prometheus_service//\//_}" get_prometheus_disk_usage > "$tmp_dir/.disk" &
+fi
+
+node_metrics=$(get_node_metrics)
 if [ $? -ne 0 ]; then
     echo "Failed to get node data."
     exit 1
 fi
 
-echo "$top_nodes" | while read -r line; do
-    node_name=$(echo $line | awk '{print $1}')
-    cpu_cores=$(echo $line | awk '{print $2}')
-    cpu_percentage=$(echo $line | awk '{print $3}')
-    memory_bytes=$(echo $line | awk '{print $4}')
-    memory_percentage=$(echo $line | awk '{print $5}')
+node_lines=()
+while read -r line; do
+    [ -n "$line" ] && node_lines+=("$line")
+done <<< "$node_metrics"
 
-    disk_usage=$(get_disk_usage "$node_name")
+if [ "$metrics_source" = summary ]; then
+    # keep at most $concurrency requests in flight against the API server
+    running=0
+    for line in "${node_lines[@]}"; do
+        if [ "$running" -ge "$concurrency" ]; then
+            if [ "$has_wait_n" = true ]; then
+                wait -n
+                running=$((running - 1))
+            else
+                wait
+                running=0
+            fi
+        fi
+        read -r node_name _ <<< "$line"
+        cached "$disk_cache_ttl" "summary-$node_name" get_disk_usage "$node_name" > "$tmp_dir/$node_name" &
+        running=$((running + 1))
+    done
+    wait
+else
+    # one response covers every node instead of a proxied kubelet request per node;
+    # node-status reuses the node list already fetched for allocatable
+    if [ "$metrics_source" = node-status ]; then
+        jq -r "$DISK_PRESSURE_JQ" "$tmp_dir/.nodes" > "$tmp_dir/.disk"
+    fi
+    wait
+    # keep only results for known nodes, so stray labels never become file names
+    printf '%s\n' "${node_lines[@]}" \
+        | awk 'NR == FNR { known[$1]; next } $1 in known' - "$tmp_dir/.disk" > "$tmp_dir/.disk.known"
+    if [ "$metrics_source" = prometheus ] && [ -s "$tmp_dir/.disk" ] && [ ! -s "$tmp_dir/.disk.known" ]; then
+        echo "No Prometheus series has a \"node\" or \"instance\" label matching a node name." >&2
+    fi
+    while read -r node_name disk_usage; do
+        echo "$disk_usage" > "$tmp_dir/$node_name"
+    done < "$tmp_dir/.disk.known"
+fi
 
-    printf "%-${name_width}s %-${cpu_cores_width}s %-${cpu_percentage_width}s %-${memory_bytes_width}s %-${memory_percentage_width}s %-${disk_usage_width}s\n" "$node_name" "$cpu_cores" "$cpu_percentage" "$memory_bytes" "$memory_percentage" "$disk_usage"
+# build the whole table and write it out at once instead of once per row
+disk_header="DISK USAGE%"
+if [ "$metrics_source" = node-status ]; then
+    disk_header="DISK PRESSURE"
+fi
+printf -v table "$row_format" "NAME" "CPU(cores)" "CPU%" "MEMORY(bytes)" "MEMORY%" "$disk_header"
+
+for line in "${node_lines[@]}"; do
+    read -r node_name cpu_cores cpu_percentage memory_bytes memory_percentage _ <<< "$line"
+
+    disk_usage="Error"
+    if [ -s "$tmp_dir/$node_name" ]; then
+        read -r disk_usage < "$tmp_dir/$node_name"
+    fi
+
+    printf -v row "$row_format" "$node_name" "$cpu_cores" "$cpu_percentage" "$memory_bytes" "$memory_percentage" "$disk_usage"
+    table+=$row
 done
+
+printf '%s' "$table"